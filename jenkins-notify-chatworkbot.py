@@ -25,6 +25,9 @@ import traceback
 import urllib
 import urllib2
 import json
+import threading
+import Queue
+from collections import deque
 from xml.dom.minidom import parseString
 
 ################################################################################
@@ -70,11 +73,25 @@ class BuildInfo(object):
     u'''
     最新のビルド情報とかに使うクラス
     '''
-    def __init__(self, full_display_name, job_url, is_building, status):
+    def __init__(self, full_display_name, job_url, is_building, status, timestamp = None, duration = None):
+        u'''
+        :param timestamp: ビルド開始時刻(epoch秒)
+        :param duration: ビルド所要時間(秒)
+        :rtype : BuildInfo
+        '''
         self.full_display_name = full_display_name
         self.job_url = job_url
         self.is_building = is_building
         self.status = status
+        self.timestamp = timestamp
+        self.duration = duration
+
+    def completed_at(self):
+        u'''
+        ビルド完了時刻(epoch秒)を返却. 不明な場合はNone
+        '''
+        if self.timestamp is None or self.is_building: return None
+        return self.timestamp + (self.duration or 0)
 
     @staticmethod
     def from_jenkins_job_last_build(xml):
@@ -87,7 +104,16 @@ class BuildInfo(object):
         is_building = True if building == 'true' else False
         status = 'BUILDING' if is_building else xml.getElementsByTagName('result')[0].childNodes[0].data
         job_url = xml.getElementsByTagName('url')[0].childNodes[0].data
-        return BuildInfo(full_display_name, job_url, is_building, status)
+        # Jenkinsはミリ秒で返してくるので秒に直しておく
+        timestamp = BuildInfo._parse_millis(xml, 'timestamp')
+        duration = BuildInfo._parse_millis(xml, 'duration')
+        return BuildInfo(full_display_name, job_url, is_building, status, timestamp, duration)
+
+    @staticmethod
+    def _parse_millis(xml, tag_name):
+        elements = xml.getElementsByTagName(tag_name)
+        if not elements or not elements[0].childNodes: return None
+        return int(elements[0].childNodes[0].data) / 1000.0
 
 class Identity(object):
     u'''
@@ -365,8 +391,15 @@ class JenkinsNotifyPolicy(object):
         if value == 'build_success': return JenkinsNotifyPolicy.BUILD_SUCCESS
         return JenkinsNotifyPolicy.BUILD
 
+    @staticmethod
+    def to_str(value):
+        if value == JenkinsNotifyPolicy.BUILD: return 'build'
+        if value == JenkinsNotifyPolicy.BUILD_FIXED: return 'build_fixed'
+        if value == JenkinsNotifyPolicy.BUILD_SUCCESS: return 'build_success'
+        return 'build'
+
 class JenkinsNotifyReport(object):
-    def __init__(self, job_name, full_display_name, policy, is_success, status, link):
+    def __init__(self, job_name, full_display_name, policy, is_success, status, link, completed_at = None, detected_at = None):
         u'''
         :param job_name: job名
         :param full_display_name: job名とビルド番号を含む表示名
@@ -374,6 +407,8 @@ class JenkinsNotifyReport(object):
         :param is_success: ビルドが成功したか否か
         :param status: ビルドの詳細ステータス
         :param link: ビルド情報がみれるJenkinのURL
+        :param completed_at: ビルド完了時刻(epoch秒)
+        :param detected_at: botがビルド完了を検知した時刻(epoch秒)
         :rtype : JenkinsNotifyReport
         '''
         self.job_name = job_name
@@ -382,6 +417,262 @@ class JenkinsNotifyReport(object):
         self.is_success = is_success
         self.status = status
         self.link = link
+        self.completed_at = completed_at
+        self.detected_at = detected_at
+
+class NotifyLatencyRecorder(object):
+    u'''
+    ビルド完了からchatworkに投稿されるまでの遅延を記録するクラス
+    option/部屋ごとに「ビルド完了→検知」「検知→chatwork応答」を秒で保持する
+    '''
+    default_max_samples = 1000
+    default_percentiles = [50, 90, 99]
+    def __init__(self, max_samples = default_max_samples):
+        self.max_samples = max_samples
+        self._samples = {}
+
+    def record(self, option_name, room_id, completed_at, detected_at, acked_at):
+        u'''
+        :param option_name: JenkinsNotifyOptionの名前
+        :param room_id: ChatworkRoomのID
+        :param completed_at: ビルド完了時刻(epoch秒)
+        :param detected_at: botがビルド完了を検知した時刻(epoch秒)
+        :param acked_at: chatworkから応答が返ってきた時刻(epoch秒)
+        '''
+        if detected_at is None: return
+        samples = self._samples.setdefault((option_name, room_id), {'detect': [], 'ack': []})
+        if completed_at is not None:
+            self._append(samples['detect'], detected_at - completed_at)
+        self._append(samples['ack'], acked_at - detected_at)
+
+    def _append(self, values, value):
+        values.append(value)
+        if len(values) > self.max_samples: del values[0]
+
+    def percentiles(self, option_name, room_id, percentiles = default_percentiles):
+        u'''
+        指定したoption/部屋の遅延のパーセンタイルを返却
+        :rtype : dict {'detect': {50: sec, ...}, 'ack': {50: sec, ...}}
+        '''
+        samples = self._samples.get((option_name, room_id), {'detect': [], 'ack': []})
+        r = {}
+        for kind, values in samples.iteritems():
+            r[kind] = dict((p, NotifyLatencyRecorder._percentile(values, p)) for p in percentiles)
+        return r
+
+    def summary(self):
+        u'''
+        全option/部屋分の遅延のパーセンタイルをログ用の文字列で返却
+        '''
+        lines = []
+        for option_name, room_id in sorted(self._samples.iterkeys()):
+            stats = self.percentiles(option_name, room_id)
+            line = '%s room:%s' % (option_name, room_id)
+            for kind in ['detect', 'ack']:
+                for p in sorted(stats[kind].iterkeys()):
+                    value = stats[kind][p]
+                    line += ' %s_p%d:%s' % (kind, p, '-' if value is None else '%.1fs' % value)
+            lines.append(line)
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _percentile(values, p):
+        if not values: return None
+        ordered = sorted(values)
+        index = int(round((len(ordered) - 1) * p / 100.0))
+        return ordered[index]
+
+class JenkinsNotifyOutbox(object):
+    u'''
+    送信予定のメッセージと新しいビルド情報をまとめて保存する追記型のjournal
+    1行1レコードのJSONで、以下の4種類
+    * commit: そのサイクルで保存すべきビルド情報と送信予定のメッセージ一式
+    * applied: 直前のcommitのビルド情報をlast_build_statusに書き込み済み
+    * sent: keyで指定したメッセージを送信済み
+    * dead: keyで指定したメッセージはretry_period秒たっても送れなかったので諦めた(dead letterに移した)
+    commitを先にfsyncしておくことで、送信中に落ちても再起動時に続きから送信できる
+    '''
+    default_retry_period = 60 * 60
+    def __init__(self, path, retry_period = default_retry_period):
+        self.path = path
+        self.dead_letter_path = path + '.dead'
+        self.retry_period = retry_period
+
+    def commit(self, build_status_lines, messages):
+        u'''
+        ビルド情報と送信予定のメッセージをまとめて書き込み、fsyncする
+        :param build_status_lines: BuildStatus.to_stored_line()のリスト
+        :param messages: 送信予定のメッセージ(dict)のリスト. 'key'を必ず含むこと
+        '''
+        record = {'type': 'commit', 'build_status': build_status_lines, 'messages': messages}
+        self._append([record])
+        # 読み戻せて初めてcommit済みとみなす
+        if self._read_last_record() != json.loads(json.dumps(record)): raise Exception('outbox commit could not be read back')
+
+    def applied(self):
+        u'''
+        直前のcommitのビルド情報をlast_build_statusに書き込み済みとして記録
+        以降のload()ではそのビルド情報を返さないので、より新しい状態を巻き戻すことがない
+        '''
+        self._append([{'type': 'applied'}])
+
+    def ack(self, key):
+        u'''
+        keyで指定したメッセージを送信済みとして記録
+        '''
+        self._append([{'type': 'sent', 'key': key}])
+
+    def fail(self, message):
+        u'''
+        メッセージの送信失敗を処理. 作られてからretry_period秒たっていたらdead letterに移し、Trueを返却
+        まだなら次のサイクルで再送するので何もしない
+        '''
+        if time.time() - message.get('created_at', time.time()) < self.retry_period: return False
+        with open(self.dead_letter_path, 'a') as f:
+            f.write(json.dumps(message))
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._append([{'type': 'dead', 'key': message['key']}])
+        return True
+
+    def load(self):
+        u'''
+        journalを読み込み、まだ反映されていない最新のビルド情報と未送信のメッセージを返却
+        :rtype : (build_status_lines or None, [message, ...])
+        '''
+        build_status_lines = None
+        messages = []
+        sent_keys = set()
+        if not os.path.exists(self.path): return build_status_lines, messages
+        with open(self.path, 'r') as f: lines = f.readlines()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 書き込み途中で落ちた行は捨てる
+                continue
+            if record['type'] == 'commit':
+                build_status_lines = record['build_status']
+                messages.extend(record['messages'])
+            elif record['type'] == 'applied':
+                build_status_lines = None
+            elif record['type'] == 'sent' or record['type'] == 'dead':
+                sent_keys.add(record['key'])
+        pending = [message for message in messages if message['key'] not in sent_keys]
+        return build_status_lines, pending
+
+    def clear(self):
+        u'''
+        全部送信し終わったjournalを削除
+        '''
+        if os.path.exists(self.path): os.remove(self.path)
+
+    def _read_last_record(self):
+        with open(self.path, 'r') as f: lines = f.readlines()
+        if not lines or not lines[-1].endswith('\n'): return None
+        try:
+            return json.loads(lines[-1])
+        except ValueError:
+            return None
+
+    def _truncate_torn_tail(self):
+        u'''
+        書き込み途中で落ちて改行で終わっていない最終行を切り捨てる
+        そのまま追記すると、次のレコードまでくっついて読めなくなるため
+        '''
+        with open(self.path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0: return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == '\n': return
+            f.seek(0)
+            data = f.read()
+            f.seek(0)
+            f.truncate(data.rfind('\n') + 1)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append(self, records):
+        text_to_write = ''
+        for record in records:
+            text_to_write += json.dumps(record)
+            text_to_write += '\n'
+        is_new_file = not os.path.exists(self.path)
+        if not is_new_file: self._truncate_torn_tail()
+        with open(self.path, 'a') as f:
+            f.write(text_to_write)
+            f.flush()
+            os.fsync(f.fileno())
+        # 作ったばかりのjournalが電源断で消えないよう、ディレクトリもfsyncしておく
+        if is_new_file: JenkinsNotifyOutbox.fsync_dir(self.path)
+
+    @staticmethod
+    def fsync_dir(path):
+        u'''
+        pathを含むディレクトリをfsyncし、ファイルの作成やrenameを永続化する
+        '''
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class JenkinsNotifyDispatcher(object):
+    u'''
+    送信予定のメッセージを部屋ごとのキューに振り分けて、並行に送信するクラス
+    * 同じ部屋のメッセージは必ず積んだ順番に送る
+    * 空いたworkerは、先頭が失敗/復活の通知(URGENT)の部屋を、成功だけの通知(NORMAL)の部屋より先に処理する
+    * 送信に失敗した部屋は、順番を守るためそのサイクルでは残りを送らない
+    '''
+    URGENT = 0
+    NORMAL = 1
+    default_max_workers = 4
+    join_interval = 0.5
+    def __init__(self, max_workers = default_max_workers):
+        self.max_workers = max(1, max_workers)
+
+    def dispatch(self, messages, send, on_failure):
+        u'''
+        :param messages: 送信予定のメッセージ(dict)のリスト. 'room'と'priority'を参照する
+        :param send: メッセージを1件送信する関数. 別スレッドから呼ばれる
+        :param on_failure: 送信に失敗した時に(message, traceback文字列)で呼ばれる関数. 別スレッドから呼ばれる
+        '''
+        room_queues = {}
+        for seq, message in enumerate(messages):
+            room_queues.setdefault(message['room'], deque()).append((seq, message))
+        ready = Queue.PriorityQueue()
+        for room_id, room_queue in room_queues.iteritems():
+            self._put_room(ready, room_id, room_queue)
+        workers = []
+        for i in range(min(self.max_workers, len(room_queues))):
+            worker = threading.Thread(target = self._work, args = (ready, room_queues, send, on_failure))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        # timeoutなしのjoinだとCtrl-Cが効かなくなるので、少しずつ待つ
+        for worker in workers:
+            while worker.is_alive(): worker.join(JenkinsNotifyDispatcher.join_interval)
+
+    def _work(self, ready, room_queues, send, on_failure):
+        while True:
+            try:
+                _, _, room_id = ready.get_nowait()
+            except Queue.Empty:
+                return
+            room_queue = room_queues[room_id]
+            _, message = room_queue.popleft()
+            try:
+                send(message)
+            except Exception:
+                # 順番を守るため、この部屋の残りは次回に回す
+                on_failure(message, traceback.format_exc())
+                continue
+            if room_queue: self._put_room(ready, room_id, room_queue)
+
+    def _put_room(self, ready, room_id, room_queue):
+        seq, message = room_queue[0]
+        ready.put((message.get('priority', JenkinsNotifyDispatcher.NORMAL), seq, room_id))
 
 class JenkinsNotifyOption(object):
     default_policy = JenkinsNotifyPolicy.BUILD_FIXED
@@ -400,7 +691,8 @@ class JenkinsNotifyOption(object):
             success_messages=default_success_messages,
             failure_messages=default_failure_messages,
             success_emoticon=default_success_emoticon,
-            failure_emoticon=default_failure_emoticon):
+            failure_emoticon=default_failure_emoticon,
+            name=None):
         u'''
         :param job_names:
         :param rooms:
@@ -410,6 +702,7 @@ class JenkinsNotifyOption(object):
         :param failure_messages: 
         :param success_emotion: 
         :param failure_emoticon: 
+        :param name: 遅延の集計などに使う名前. 省略時はjob名を連結したものとpolicy
         :rtype : JenkinsNotifyOption
         '''
         self.job_names = job_names
@@ -420,6 +713,7 @@ class JenkinsNotifyOption(object):
         self.failure_messages = failure_messages
         self.success_emoticon = success_emoticon
         self.failure_emoticon = failure_emoticon
+        self.name = name if name is not None else ','.join(job_names) + ':' + JenkinsNotifyPolicy.to_str(policy)
 
     @staticmethod
     def from_json(obj):
@@ -432,6 +726,7 @@ class JenkinsNotifyOption(object):
         failure_messages = obj.get('failure_messages', JenkinsNotifyOption.default_failure_messages)
         success_emoticon = Emoticon(obj.get('success_emoticon', JenkinsNotifyOption.default_success_emoticon_str))
         failure_emoticon = Emoticon(obj.get('failure_emoticon', JenkinsNotifyOption.default_failure_emoticon_str))
+        name = obj.get('name')
         return JenkinsNotifyOption(
             jobs,
             rooms,
@@ -440,7 +735,8 @@ class JenkinsNotifyOption(object):
             success_messages,
             failure_messages,
             success_emoticon,
-            failure_emoticon
+            failure_emoticon,
+            name
         )
 
 class JenkinsNotifyConfig(object):
@@ -448,15 +744,19 @@ class JenkinsNotifyConfig(object):
     JenkinNotifyBotのConfiguration
     '''
     default_last_build_status_path = 'last_build_status.txt'
+    default_outbox_path = 'notify_outbox.txt'
     default_interval = 120
     default_notify_options = []
-    def __init__(self, checksum, api_token, jenkins_server_url, last_build_status_path, interval, notify_options):
+    default_max_concurrent_sends = JenkinsNotifyDispatcher.default_max_workers
+    def __init__(self, checksum, api_token, jenkins_server_url, last_build_status_path, interval, notify_options, outbox_path = default_outbox_path, max_concurrent_sends = default_max_concurrent_sends):
         self.checksum = checksum
         self.api_token = api_token
         self.jenkins_server_url = jenkins_server_url
         self.last_build_status_path = last_build_status_path
         self.interval = interval
         self.notify_options = notify_options
+        self.outbox_path = outbox_path
+        self.max_concurrent_sends = max_concurrent_sends
 
     @staticmethod
     def from_file(path):
@@ -474,11 +774,13 @@ class JenkinsNotifyConfig(object):
         jenkins_server_url = conf_obj['jenkins_server_url']
         last_build_status_path = conf_obj.get('last_build_status_path', JenkinsNotifyConfig.default_last_build_status_path)
         interval = conf_obj.get('interval', JenkinsNotifyConfig.default_interval)
+        outbox_path = conf_obj.get('outbox_path', JenkinsNotifyConfig.default_outbox_path)
+        max_concurrent_sends = max(1, int(conf_obj.get('max_concurrent_sends', JenkinsNotifyConfig.default_max_concurrent_sends)))
         options_json = conf_obj.get('notify_options', [])
         options = []
         for option_json in options_json:
             options.append(JenkinsNotifyOption.from_json(option_json))
-        return JenkinsNotifyConfig(checksum, api_token, jenkins_server_url, last_build_status_path, interval, options)
+        return JenkinsNotifyConfig(checksum, api_token, jenkins_server_url, last_build_status_path, interval, options, outbox_path, max_concurrent_sends)
 
     def is_same_config(self, that):
         return self.checksum == that.checksum
@@ -493,6 +795,10 @@ class JenkinsNotifyBot(object):
         self._chatwork = None
         self._jenkins = None
         self._config = None
+        self._outbox = None
+        self._dispatcher = None
+        self._latency = NotifyLatencyRecorder()
+        self._delivery_lock = threading.Lock()
 
     def run(self):
         self._update_config()
@@ -516,6 +822,8 @@ class JenkinsNotifyBot(object):
         self._config = new_config
         self._chatwork = ChatworkClient(self._config.api_token)
         self._jenkins = JenkinsClient(self._config.jenkins_server_url)
+        self._outbox = JenkinsNotifyOutbox(self._config.outbox_path)
+        self._dispatcher = JenkinsNotifyDispatcher(self._config.max_concurrent_sends)
         print '%s Configuration has been updated.' % (datetime.datetime.today().strftime('%x %X'))
 
     def _process(self):
@@ -526,6 +834,19 @@ class JenkinsNotifyBot(object):
         3. 最新ビルドがコケてたら通知
         4. コケてた状態から最新ビルドで復帰したら、通知
         5. デプロイ通知したいjobがあったら、最新ビルドが更新されてたら毎度通知
+        前回送りきれなかった通知も、新しい通知と一緒にサイクルの最後に1回だけ送る
+        送れない部屋があってもJenkinsの監視は続ける
+        '''
+        self._recover_outbox()
+        try:
+            self._poll_jenkins()
+        finally:
+            _, pending = self._outbox.load()
+            self._deliver_outbox(pending)
+
+    def _poll_jenkins(self):
+        u'''
+        Jenkinsの最新ビルドをチェックして通知をoutboxにcommitし、ビルド情報を保存
         '''
         last_build_status = self._read_last_build_status()
         new_build_status = self._jenkins.rss_latest()
@@ -543,6 +864,7 @@ class JenkinsNotifyBot(object):
 
             # updated!
             build_info = self._jenkins.job_last_build(job_name)
+            detected_at = time.time()
 
             # continue if building now
             if build_info.is_building:
@@ -561,7 +883,9 @@ class JenkinsNotifyBot(object):
                     JenkinsNotifyPolicy.BUILD,
                     is_new_build_success,
                     build_info.status,
-                    build_info.job_url
+                    build_info.job_url,
+                    build_info.completed_at(),
+                    detected_at
                 )
             )
 
@@ -575,7 +899,9 @@ class JenkinsNotifyBot(object):
                         JenkinsNotifyPolicy.BUILD_FIXED,
                         is_build_fixed,
                         build_info.status,
-                        build_info.job_url
+                        build_info.job_url,
+                        build_info.completed_at(),
+                        detected_at
                     )
                 )
 
@@ -588,7 +914,9 @@ class JenkinsNotifyBot(object):
                         JenkinsNotifyPolicy.BUILD_SUCCESS,
                         is_new_build_success,
                         build_info.status,
-                        build_info.job_url
+                        build_info.job_url,
+                        build_info.completed_at(),
+                        detected_at
                     )
                 )
 
@@ -596,8 +924,11 @@ class JenkinsNotifyBot(object):
             build_status.last_status = build_info.status
             build_status_for_save[job_name] = build_status
 
-        self._notify_reports(reports, self._config.notify_options)
+        messages = self._notify_reports(reports, self._config.notify_options)
+        build_status_lines = [status.to_stored_line() for status in build_status_for_save.itervalues()]
+        if messages: self._outbox.commit(build_status_lines, messages)
         self._write_last_build_status(build_status_for_save)
+        if messages: self._outbox.applied()
 
     def _detect_build_condition(self, last_status, new_status):
         is_new_build_success = (new_status == 'SUCCESS')
@@ -613,16 +944,22 @@ class JenkinsNotifyBot(object):
 
     def _notify_reports(self, reports, options):
         u'''
-
+        reportsをoptionごとにまとめて、部屋ごとの送信予定メッセージを生成
         :param reports:
         :param options:
+        :rtype : list of dict (outboxにそのまま書き込める形)
         '''
+        created_at = time.time()
+        commit_id = '%f-%d' % (created_at, random.randint(0, 0xffff))
+        messages = []
         for option in options:
             body = ''
             is_failure_once = False
+            option_reports = []
             for report in reports:
                 if report.policy != option.policy: continue
                 if not (report.job_name in option.job_names): continue
+                option_reports.append(report)
                 emoticon = option.success_emoticon if report.is_success else option.failure_emoticon
                 if not is_failure_once: is_failure_once = not report.is_success
                 body += self._build_message(report.full_display_name, emoticon, option.message_prefix, report.status, report.link)
@@ -635,11 +972,69 @@ class JenkinsNotifyBot(object):
                 random.shuffle(option.success_messages)
                 title = option.success_messages[0]
             message = self._decorate_message(title, body)
+            latencies = [[report.completed_at, report.detected_at] for report in option_reports]
+            is_urgent = is_failure_once or option.policy == JenkinsNotifyPolicy.BUILD_FIXED
+            priority = JenkinsNotifyDispatcher.URGENT if is_urgent else JenkinsNotifyDispatcher.NORMAL
             for room in option.rooms:
-                print room.id
-                print message
-                print '\n'
-                self._chatwork.send_message(room, message)
+                messages.append({
+                    'key': '%s-%d' % (commit_id, len(messages)),
+                    'option': option.name,
+                    'room': room.id,
+                    'body': message,
+                    'priority': priority,
+                    'created_at': created_at,
+                    'latencies': latencies
+                })
+        return messages
+
+    def _recover_outbox(self):
+        u'''
+        前回のサイクルで保存しきれなかったビルド情報を反映. 送りきれなかったメッセージはサイクルの最後に送る
+        '''
+        build_status_lines, _ = self._outbox.load()
+        if build_status_lines is None: return
+        build_status = {}
+        for line in build_status_lines:
+            status = BuildStatus.from_stored_line(line)
+            build_status[status.job_name] = status
+        self._write_last_build_status(build_status)
+        self._outbox.applied()
+
+    def _deliver_outbox(self, pending):
+        u'''
+        outboxに残っている未送信のメッセージを部屋ごとに並行して送信し、送るたびに送信済みを記録
+        :param pending: JenkinsNotifyOutbox.load()で取得した未送信のメッセージ
+        '''
+        self._dispatcher.dispatch(pending, self._send_outbox_message, self._fail_outbox_message)
+        # 送りきれなかったものが残っていたら、journalは次のサイクルのために残しておく
+        _, rest = self._outbox.load()
+        if not rest: self._outbox.clear()
+        if len(rest) < len(pending):
+            print '%s Notify latency\n%s' % (datetime.datetime.today().strftime('%x %X'), self._latency.summary())
+
+    def _send_outbox_message(self, message):
+        u'''
+        outboxのメッセージを1件送信. JenkinsNotifyDispatcherのworkerスレッドから呼ばれる
+        '''
+        self._chatwork.send_message(ChatworkRoom(message['room']), message['body'])
+        acked_at = time.time()
+        with self._delivery_lock:
+            print message['room']
+            print message['body']
+            print '\n'
+            self._outbox.ack(message['key'])
+            for completed_at, detected_at in message['latencies']:
+                self._latency.record(message['option'], message['room'], completed_at, detected_at, acked_at)
+
+    def _fail_outbox_message(self, message, trace):
+        u'''
+        outboxのメッセージの送信失敗を記録. 長いこと送れないものはdead letterに移す
+        JenkinsNotifyDispatcherのworkerスレッドから呼ばれる
+        '''
+        with self._delivery_lock:
+            print '%s %s' % (datetime.datetime.today().strftime('%x %X'), trace)
+            if self._outbox.fail(message):
+                print '%s Gave up sending to room %s: moved to %s' % (datetime.datetime.today().strftime('%x %X'), message['room'], self._outbox.dead_letter_path)
 
     def _build_message(self, job_name, emoticon, prefix, status, url):
         u'''
@@ -695,7 +1090,14 @@ class JenkinsNotifyBot(object):
         for build_status in build_status.itervalues():
             text_to_write += build_status.to_stored_line()
             text_to_write += '\n'
-        with open(self._config.last_build_status_path, 'w+') as f: f.write(text_to_write)
+        # 書き込み途中で落ちても壊れないように、一時ファイルに書いてから差し替える
+        tmp_path = self._config.last_build_status_path + '.tmp'
+        with open(tmp_path, 'w+') as f:
+            f.write(text_to_write)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._config.last_build_status_path)
+        JenkinsNotifyOutbox.fsync_dir(self._config.last_build_status_path)
 
 ################################################################################
 ###                               entry point                                ###